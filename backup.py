@@ -4,16 +4,87 @@ Incremental Backup Script with Cloudflare R2 Storage
 Uses docker exec to backup PostgreSQL and uploads to R2.
 """
 
+import errno
+import io
+import mmap
 import subprocess
 import os
-import hashlib
-import json
+import queue
+import re
+import tarfile
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
+from functools import lru_cache
 from pathlib import Path
+from typing import Optional
+
+import orjson
 
 SCRIPT_DIR = Path(__file__).parent
 BACKUP_DIR = SCRIPT_DIR / "dumps"
 STATE_FILE = SCRIPT_DIR / "backup_state.json"
+MANIFEST_FILE = SCRIPT_DIR / "backup_manifest"
+
+# Buffer size for the tar stream copied out of the container
+READ_SIZE = 8 * 1024 * 1024
+
+# Blocks of READ_SIZE the pipe reader may get ahead of the tar rewriter
+READ_AHEAD = 4
+
+# Kernel buffer of the pipe from docker cp (the Linux default is 64 KB, the default limit 1 MB)
+PIPE_SIZE = 1024 * 1024
+
+# Local backup files, and what interrupted runs (manifests) and restores (.part) leave next to them
+BACKUP_SUFFIXES = (".tar", ".sql")
+LEFTOVER_SUFFIXES = (".manifest", ".part")
+
+# Scratch directory inside the container for directory-format dumps
+CONTAINER_DUMP_DIR = "/tmp"
+
+# KEY=value lines of the .env file; comment lines are skipped, values are taken as-is
+ENV_LINE = re.compile(r"^[ \t]*([^#=\s][^=\n]*?)[ \t]*=[ \t]*(.*?)[ \t\r]*$", re.M)
+
+# Chunk fingerprint algorithm, stored in state and recipes
+HASH_ALGO = "blake3"
+
+
+@dataclass(frozen=True)
+class Config:
+    """Script configuration, loaded once from the environment by load_env()."""
+    container_name: str
+    db_name: Optional[str]
+    db_user: Optional[str]
+    dump_jobs: int
+    dump_compression: str
+    backup_mode: str
+    full_backup_days: int
+
+    r2_account_id: Optional[str]
+    r2_access_key: Optional[str]
+    r2_secret_key: Optional[str]
+    r2_bucket: Optional[str]
+    r2_prefix: str
+    r2_concurrency: int
+    chunk_size: int
+
+    keep_local_days: int
+    keep_remote_days: int
+
+    aws_access_key: Optional[str]
+    aws_secret_key: Optional[str]
+    aws_region: str
+    email_from: Optional[str]
+    email_to: Optional[str]
+
+    r2_enabled: bool = field(init=False)
+
+    def __post_init__(self):
+        configured = all((self.r2_account_id, self.r2_access_key, self.r2_secret_key, self.r2_bucket))
+        object.__setattr__(self, "r2_enabled", configured)
 
 
 def load_env():
@@ -21,51 +92,58 @@ def load_env():
     env_file = SCRIPT_DIR / ".env"
 
     if env_file.exists():
-        with open(env_file) as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith("#") and "=" in line:
-                    key, value = line.split("=", 1)
-                    value = value.strip().strip('"').strip("'")
-                    os.environ.setdefault(key, value)
-
-    return {
+        for match in ENV_LINE.finditer(env_file.read_text()):
+            key, value = match.groups()
+            os.environ.setdefault(key, value.strip('"').strip("'"))
+
+    return Config(
         # Docker/DB config
-        "container_name": os.environ.get("CONTAINER_NAME", "saifer-postgres-1"),
-        "db_name": os.environ.get("DB_NAME"),
-        "db_user": os.environ.get("DB_USER"),
+        container_name=os.environ.get("CONTAINER_NAME", "saifer-postgres-1"),
+        db_name=os.environ.get("DB_NAME"),
+        db_user=os.environ.get("DB_USER"),
+        dump_jobs=int(os.environ.get("DUMP_JOBS", "4")),
+        dump_compression=os.environ.get("DUMP_COMPRESSION", "auto"),
+        backup_mode=os.environ.get("BACKUP_MODE", "dump"),
+        full_backup_days=int(os.environ.get("FULL_BACKUP_DAYS", "7")),
 
         # R2 config
-        "r2_account_id": os.environ.get("R2_ACCOUNT_ID"),
-        "r2_access_key": os.environ.get("R2_ACCESS_KEY_ID"),
-        "r2_secret_key": os.environ.get("R2_SECRET_ACCESS_KEY"),
-        "r2_bucket": os.environ.get("R2_BUCKET_NAME"),
-        "r2_prefix": os.environ.get("R2_PREFIX", "backups"),
+        r2_account_id=os.environ.get("R2_ACCOUNT_ID"),
+        r2_access_key=os.environ.get("R2_ACCESS_KEY_ID"),
+        r2_secret_key=os.environ.get("R2_SECRET_ACCESS_KEY"),
+        r2_bucket=os.environ.get("R2_BUCKET_NAME"),
+        r2_prefix=os.environ.get("R2_PREFIX", "backups"),
+        r2_concurrency=int(os.environ.get("R2_CONCURRENCY", "16")),
+        chunk_size=int(os.environ.get("R2_CHUNK_MB", "8")) * 1024 * 1024,
 
         # Retention
-        "keep_local_days": int(os.environ.get("KEEP_LOCAL_DAYS", "7")),
-        "keep_remote_days": int(os.environ.get("KEEP_REMOTE_DAYS", "30")),
+        keep_local_days=int(os.environ.get("KEEP_LOCAL_DAYS", "7")),
+        keep_remote_days=int(os.environ.get("KEEP_REMOTE_DAYS", "30")),
 
         # AWS SES config
-        "aws_access_key": os.environ.get("AWS_ACCESS_KEY_ID"),
-        "aws_secret_key": os.environ.get("AWS_SECRET_ACCESS_KEY"),
-        "aws_region": os.environ.get("AWS_REGION", "us-west-1"),
-        "email_from": os.environ.get("EMAIL_FROM"),
-        "email_to": os.environ.get("EMAIL_TO"),
-    }
+        aws_access_key=os.environ.get("AWS_ACCESS_KEY_ID"),
+        aws_secret_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
+        aws_region=os.environ.get("AWS_REGION", "us-west-1"),
+        email_from=os.environ.get("EMAIL_FROM"),
+        email_to=os.environ.get("EMAIL_TO"),
+    )
 
 
+@lru_cache(maxsize=1)
 def get_r2_client(config):
-    """Create R2 client using boto3."""
+    """Create the R2 client, shared by every R2 call in the process."""
     import boto3
-    from botocore.config import Config
+    from botocore.config import Config as BotoConfig
 
     return boto3.client(
         "s3",
-        endpoint_url=f"https://{config['r2_account_id']}.r2.cloudflarestorage.com",
-        aws_access_key_id=config["r2_access_key"],
-        aws_secret_access_key=config["r2_secret_key"],
-        config=Config(signature_version="s3v4"),
+        endpoint_url=f"https://{config.r2_account_id}.r2.cloudflarestorage.com",
+        aws_access_key_id=config.r2_access_key,
+        aws_secret_access_key=config.r2_secret_key,
+        config=BotoConfig(
+            signature_version="s3v4",
+            max_pool_connections=config.r2_concurrency,
+            retries={"mode": "adaptive", "max_attempts": 5}
+        ),
         region_name="auto"
     )
 
@@ -73,79 +151,565 @@ def get_r2_client(config):
 def load_state():
     """Load previous backup state."""
     if STATE_FILE.exists():
-        with open(STATE_FILE) as f:
-            return json.load(f)
-    return {"last_hash": None, "backups": []}
+        return orjson.loads(STATE_FILE.read_bytes())
+    return {"chunks": [], "backups": []}
 
 
 def save_state(state):
     """Save backup state."""
-    with open(STATE_FILE, "w") as f:
-        json.dump(state, f, indent=2, default=str)
+    STATE_FILE.write_bytes(orjson.dumps(state, option=orjson.OPT_INDENT_2))
+
+
+def chunk_hasher(data):
+    """Create a BLAKE3 hasher for a chunk (SIMD, multithreaded on large inputs)."""
+    from blake3 import blake3
+
+    return blake3(data, max_threads=blake3.AUTO)
+
+
+class ChunkWriter:
+    """File-like sink that writes through to a file and splits the data into content-defined chunks."""
+
+    def __init__(self, f, avg_size):
+        self.f = f
+        # FastCDC bounds around the average chunk size
+        self.min_size = avg_size // 4
+        self.avg_size = avg_size
+        self.max_size = avg_size * 2
+        self.chunks = []
+        self.offset = 0
+        self.pending = bytearray()
+
+    def write(self, data):
+        self.f.write(data)
+        self.pending += data
+        self._cut(final=False)
+        return len(data)
+
+    def tell(self):
+        return self.offset + len(self.pending)
+
+    def cut(self):
+        """End the current chunk here, unless that would leave a chunk below the minimum size."""
+        if len(self.pending) >= self.min_size:
+            self._cut(final=True)
+
+    def finish(self):
+        """Chunk the remaining data and return the chunk list."""
+        self._cut(final=True)
+        return self.chunks
+
+    def _cut(self, final):
+        from fastcdc import fastcdc
+
+        # A boundary is final once max_size bytes after the chunk start are buffered
+        while len(self.pending) >= self.max_size or (final and self.pending):
+            window = self.pending[:self.max_size]
+            chunk = next(fastcdc(window, self.min_size, self.avg_size, self.max_size, hf=chunk_hasher))
+            length, fp = chunk.length, chunk.hash
+
+            # Don't leave a tail below the minimum size: take it along if that fits, or split the
+            # rest so both chunks stay between min_size and max_size
+            tail = len(self.pending) - length
+            if final and 0 < tail < self.min_size:
+                length = len(self.pending) if len(self.pending) <= self.max_size else len(self.pending) - self.min_size
+                fp = chunk_hasher(bytes(self.pending[:length])).hexdigest()
+
+            self.chunks.append({"offset": self.offset, "len": length, "fp": fp})
+            self.offset += length
+            del self.pending[:length]
+
+
+def known_fingerprints(state):
+    """Chunk fingerprints of the last upload, empty if they used another hash algorithm."""
+    if state.get("hash_algo") != HASH_ALGO:
+        return []
+    return [c["fp"] for c in state.get("chunks", [])]
+
+
+def chunk_key(config, fp):
+    """R2 key of a content-addressed chunk."""
+    return f"{config.r2_prefix}/chunks/{fp}"
+
+
+def recipe_key(config, name):
+    """R2 key of the recipe describing one backup."""
+    return f"{config.r2_prefix}/recipes/{name}.json"
+
+
+def chunk_exists(client, config, fp):
+    """Check whether a chunk is already stored in R2."""
+    try:
+        client.head_object(Bucket=config.r2_bucket, Key=chunk_key(config, fp))
+        return True
+    except client.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise
+        return False
+
+
+def load_recipe(client, config, key):
+    """Download and parse a backup recipe."""
+    response = client.get_object(Bucket=config.r2_bucket, Key=key)
+    return orjson.loads(response["Body"].read())
+
+
+def enlarge_pipe(pipe):
+    """Grow a pipe's kernel buffer, so every read moves more data (Linux only, best effort)."""
+    try:
+        import fcntl
+        # fcntl.F_SETPIPE_SZ is only exposed from Python 3.10 on
+        fcntl.fcntl(pipe.fileno(), getattr(fcntl, "F_SETPIPE_SZ", 1031), PIPE_SIZE)
+    except (ImportError, OSError):
+        pass
+
+
+class PipeReader:
+    """Read-only file object that drains a pipe on a background thread.
+
+    The producer keeps writing while the consumer chunks and hashes, instead of
+    stalling whenever the consumer is busy and the pipe buffer is full.
+    """
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.queue = queue.Queue(maxsize=READ_AHEAD)
+        self.pending = b""
+        self.eof = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def _drain(self):
+        try:
+            while not self.stopped:
+                data = self.pipe.read(READ_SIZE)
+                self.queue.put(data)
+                if not data:
+                    break
+        except Exception as e:
+            self.queue.put(e)
+
+    def read(self, size=-1):
+        if size < 0:
+            return b"".join(iter(lambda: self.read(READ_SIZE), b""))
+        if not self.pending and not self.eof:
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                raise item
+            self.pending = item
+            self.eof = not item
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def close(self):
+        """Stop the reader thread and close the pipe."""
+        self.stopped = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.pipe.close()
+
+
+def toc_body(data):
+    """Strip the header of a pg_dump archive TOC, which records when the dump was taken."""
+    try:
+        if data[:5] != b"PGDMP":
+            raise ValueError("not a pg_dump archive")
+        version, int_size = (data[5], data[6]), data[8]
+
+        def read_int(pos):
+            # A sign byte, then int_size bytes, least significant first
+            value = int.from_bytes(data[pos + 1:pos + 1 + int_size], "little")
+            return (-value if data[pos] else value), pos + 1 + int_size
+
+        # Magic, version, int size, offset size and format, then the compression
+        # (one byte from archive version 1.15, an int before)
+        pos = 11 + (1 if version >= (1, 15) else 1 + int_size)
+        # Creation time (7 ints), then database name, server version and pg_dump version
+        pos += 7 * (1 + int_size)
+        for _ in range(3):
+            length, pos = read_int(pos)
+            pos += max(length, 0)
+        if pos > len(data):
+            raise ValueError("truncated header")
+        return data[pos:]
+    except (IndexError, ValueError) as e:
+        print(f"  Could not parse the dump TOC header ({e or 'truncated header'}), fingerprinting all of toc.dat")
+        return data
+
+
+class HashingReader:
+    """Read-only file object that fingerprints everything read through it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.hasher = chunk_hasher(b"")
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.hasher.update(data)
+        return data
+
+
+def stream_from_container(config, src_dir, dest_path, files=None):
+    """Copy a directory out of the container into a tar file, chunking it on the way.
+
+    `files` maps the dump IDs of table data files to their tables. When given, every
+    file of the dump is fingerprinted by its contents (the TOC without its header).
+    Returns the chunk list and these fingerprints.
+    """
+    cmd = ["docker", "cp", f"{config.container_name}:{src_dir}", "-"]
+
+    with open(dest_path, "wb") as f, tempfile.TemporaryFile() as stderr_file:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file)
+        enlarge_pipe(proc.stdout)
+        timed_out = threading.Event()
+
+        def on_timeout():
+            timed_out.set()
+            proc.kill()
+
+        watchdog = threading.Timer(600, on_timeout)
+        watchdog.start()
+        reader = PipeReader(proc.stdout)
+        writer = ChunkWriter(f, config.chunk_size)
+        digests = {}
+        error = None
+
+        try:
+            # Unbuffered "w" mode, so every member ends exactly where the writer cuts
+            with tarfile.open(fileobj=reader, mode="r|", bufsize=READ_SIZE) as src, \
+                    tarfile.open(fileobj=writer, mode="w") as dst:
+                for member in src:
+                    # Drop the per-run directory name and file metadata, so unchanged files give identical bytes
+                    member.name = member.name.partition("/")[2]
+                    if not member.name:
+                        continue
+                    member.mtime = 0
+                    member.uid = member.gid = 0
+                    member.uname = member.gname = ""
+                    member.pax_headers = {}
+
+                    if not member.isfile():
+                        dst.addfile(member)
+                        continue
+                    if files is None:
+                        dst.addfile(member, src.extractfile(member))
+                        continue
+                    if member.name == "toc.dat":
+                        # Small enough to buffer, and its header has to be left out of the fingerprint
+                        data = src.extractfile(member).read()
+                        dst.addfile(member, io.BytesIO(data))
+                        digests[member.name] = chunk_hasher(toc_body(data)).hexdigest()
+                        continue
+
+                    data = HashingReader(src.extractfile(member))
+                    dst.addfile(member, data)
+                    digests[member.name] = data.hasher.hexdigest()
+                    if member.name.split(".")[0] in files:
+                        # End every table on a chunk boundary, so a change can't shift the chunks of the tables after it
+                        writer.cut()
+            reader.read()
+        except tarfile.TarError as e:
+            error = e
+        finally:
+            if not reader.eof:
+                # Stopped early, so docker cp won't get to the end of its output by itself
+                proc.kill()
+            reader.close()
+            returncode = proc.wait()
+            watchdog.cancel()
+
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(cmd, 600)
+        if returncode != 0 or error:
+            stderr_file.seek(0)
+            raise RuntimeError(stderr_file.read().decode(errors="replace").strip() or error)
+
+        return writer.finish(), digests
+
+
+def remove_from_container(config, path):
+    """Delete a scratch path inside the container, ignoring failures."""
+    try:
+        subprocess.run(
+            ["docker", "exec", config.container_name, "rm", "-rf", path],
+            capture_output=True,
+            timeout=60
+        )
+    except (OSError, subprocess.SubprocessError):
+        pass
+
+
+def run_psql(config, sql):
+    """Run a query inside the container and return its unaligned output."""
+    result = subprocess.run(
+        [
+            "docker", "exec", config.container_name,
+            "psql",
+            "-U", config.db_user,
+            "-d", config.db_name,
+            "-tAc", sql
+        ],
+        capture_output=True,
+        text=True,
+        timeout=60
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip())
+    return result.stdout.strip()
+
+
+def incremental_supported(config):
+    """Check that the server can take incremental base backups (PostgreSQL 17+ with summarize_wal)."""
+    try:
+        version, summarize_wal = run_psql(
+            config, "SELECT current_setting('server_version_num'), current_setting('summarize_wal', true)"
+        ).split("|")
+    except Exception as e:
+        print(f"  Could not check server version ({e}), using pg_dump")
+        return False
+
+    if int(version) < 170000:
+        print(f"  Server version {version} has no incremental backups, using pg_dump")
+        return False
+    if summarize_wal != "on":
+        print("  summarize_wal is off, using pg_dump")
+        return False
+    return True
+
+
+def current_wal_lsn(config):
+    """Return the server's WAL position (replayed position on a standby), or None if it can't be read."""
+    try:
+        return run_psql(
+            config,
+            "SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END"
+        ) or None
+    except Exception as e:
+        print(f"  Could not read WAL position ({e}), dumping anyway")
+        return None
+
+
+def list_dump_tables(config, dump_dir):
+    """Map the data files of a directory-format dump to their tables, using its TOC."""
+    result = subprocess.run(
+        ["docker", "exec", config.container_name, "pg_restore", "-l", dump_dir],
+        capture_output=True,
+        text=True,
+        timeout=60
+    )
+    if result.returncode != 0:
+        print(f"  Could not list the dump's tables: {result.stderr.strip()}")
+        return None
+
+    # TOC lines look like "3345; 0 16390 TABLE DATA public Order Items postgres", with names
+    # unquoted, so the table name is everything between the schema and the owner
+    files = {}
+    for line in result.stdout.splitlines():
+        match = re.match(r"(\d+); \d+ \d+ TABLE DATA (\S+) (.+) (\S+)$", line)
+        if match:
+            files[match.group(1)] = f"{match.group(2)}.{match.group(3)}"
+    return files
 
 
-def calculate_hash(file_path):
-    """Calculate MD5 hash of a file."""
-    hash_md5 = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+def dump_compression(config):
+    """pg_dump -Z value: zstd when the container's pg_dump supports it (16+), else pg_dump's default."""
+    if config.dump_compression != "auto":
+        return config.dump_compression
+
+    try:
+        result = subprocess.run(
+            ["docker", "exec", config.container_name, "pg_dump", "--version"],
+            capture_output=True,
+            text=True,
+            timeout=60
+        )
+        major = int(re.search(r"\d+", result.stdout).group())
+    except (OSError, subprocess.SubprocessError, AttributeError):
+        return None
+
+    return "zstd:3" if major >= 16 else None
 
 
 def create_backup(config):
-    """Create backup using docker exec."""
+    """Create a parallel directory-format backup using docker exec."""
     BACKUP_DIR.mkdir(exist_ok=True)
 
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_filename = f"backup_{config['db_name']}_{timestamp}.sql"
+    backup_filename = f"backup_{config.db_name}_{timestamp}.tar"
     backup_path = BACKUP_DIR / backup_filename
+    dump_dir = f"{CONTAINER_DUMP_DIR}/{backup_path.stem}"
 
     print(f"Creating backup...")
-    print(f"  Container: {config['container_name']}")
-    print(f"  Database: {config['db_name']}")
-    print(f"  User: {config['db_user']}")
+    print(f"  Container: {config.container_name}")
+    print(f"  Database: {config.db_name}")
+    print(f"  User: {config.db_user}")
+    print(f"  Jobs: {config.dump_jobs}")
 
     cmd = [
-        "docker", "exec", config["container_name"],
+        "docker", "exec", config.container_name,
         "pg_dump",
-        "-U", config["db_user"],
-        "-d", config["db_name"],
+        "-U", config.db_user,
+        "-d", config.db_name,
+        "-Fd",
+        "-j", str(config.dump_jobs),
+        "-f", dump_dir,
         "--no-owner",
         "--no-acl"
     ]
 
+    # Tables are compressed one file each, so unchanged tables still give identical chunks
+    compression = dump_compression(config)
+    if compression:
+        print(f"  Compression: {compression}")
+        cmd += ["-Z", compression]
+
     try:
-        with open(backup_path, 'w') as f:
-            result = subprocess.run(
-                cmd,
-                stdout=f,
-                stderr=subprocess.PIPE,
-                text=True,
-                timeout=600
+        result = subprocess.run(
+            cmd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            timeout=600
+        )
+
+        if result.returncode != 0:
+            print(f"  Failed: {result.stderr}")
+            return None, None, None, None
+
+        # Without the table list, the dump's files are still fingerprinted, just not cut per table
+        files = list_dump_tables(config, dump_dir) or {}
+
+        # Fingerprint while copying, so the dump never has to be read back for hashing
+        chunks, digests = stream_from_container(config, dump_dir, backup_path, files)
+        size_mb = backup_path.stat().st_size / (1024 * 1024)
+        print(f"  Created: {backup_filename} ({size_mb:.2f} MB)")
+        tables = {files[name.split(".")[0]]: fp for name, fp in digests.items() if name.split(".")[0] in files}
+        # Changed if any table, the schema or another file of the dump changed
+        content = chunk_hasher(orjson.dumps(digests, option=orjson.OPT_SORT_KEYS)).hexdigest()
+        return backup_path, chunks, tables, content
+
+    except subprocess.TimeoutExpired:
+        print("  Timeout after 10 minutes")
+    except Exception as e:
+        print(f"  Error: {e}")
+    finally:
+        remove_from_container(config, dump_dir)
+
+    if backup_path.exists():
+        backup_path.unlink()
+    return None, None, None, None
+
+
+def create_basebackup(config, prev_manifest=None):
+    """Create a full or block-level incremental cluster backup with pg_basebackup."""
+    BACKUP_DIR.mkdir(exist_ok=True)
+
+    kind = "incr" if prev_manifest else "full"
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    backup_filename = f"backup_{config.db_name}_{kind}_{timestamp}.tar"
+    backup_path = BACKUP_DIR / backup_filename
+    backup_dir = f"{CONTAINER_DUMP_DIR}/{backup_path.stem}"
+    container_manifest = f"{backup_dir}.manifest"
+
+    print(f"Creating {'incremental' if prev_manifest else 'full'} base backup...")
+    print(f"  Container: {config.container_name}")
+    print(f"  User: {config.db_user}")
+
+    cmd = [
+        "docker", "exec", config.container_name,
+        "pg_basebackup",
+        "-U", config.db_user,
+        "-D", backup_dir,
+        "-c", "fast"
+    ]
+
+    try:
+        if prev_manifest:
+            # Only the previous manifest is needed, the server finds changed blocks from its WAL summaries
+            subprocess.run(
+                ["docker", "cp", str(prev_manifest), f"{config.container_name}:{container_manifest}"],
+                capture_output=True,
+                check=True,
+                timeout=60
             )
+            cmd.append(f"--incremental={container_manifest}")
+
+        result = subprocess.run(
+            cmd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+            timeout=600
+        )
 
-        if result.returncode == 0 and backup_path.exists() and backup_path.stat().st_size > 0:
-            size_mb = backup_path.stat().st_size / (1024 * 1024)
-            print(f"  Created: {backup_filename} ({size_mb:.2f} MB)")
-            return backup_path
-        else:
+        if result.returncode != 0:
             print(f"  Failed: {result.stderr}")
-            if backup_path.exists():
-                backup_path.unlink()
-            return None
+            return None, None, None, None
+
+        # Keep this backup's manifest, the next incremental backup is taken against it
+        subprocess.run(
+            [
+                "docker", "cp",
+                f"{config.container_name}:{backup_dir}/backup_manifest",
+                str(backup_path.with_suffix(".manifest"))
+            ],
+            capture_output=True,
+            check=True,
+            timeout=60
+        )
+
+        chunks, _ = stream_from_container(config, backup_dir, backup_path)
+        size_mb = backup_path.stat().st_size / (1024 * 1024)
+        print(f"  Created: {backup_filename} ({size_mb:.2f} MB)")
+        return backup_path, chunks, {}, None
 
     except subprocess.TimeoutExpired:
         print("  Timeout after 10 minutes")
-        return None
+    except subprocess.CalledProcessError as e:
+        print(f"  Manifest copy failed: {e.stderr.decode(errors='replace').strip()}")
     except Exception as e:
         print(f"  Error: {e}")
-        return None
+    finally:
+        remove_from_container(config, backup_dir)
+        remove_from_container(config, container_manifest)
+
+    if backup_path.exists():
+        backup_path.unlink()
+    return None, None, None, None
 
 
-def upload_to_r2(config, file_path):
-    """Upload backup to Cloudflare R2."""
-    if not all([config["r2_account_id"], config["r2_access_key"], config["r2_secret_key"], config["r2_bucket"]]):
+def list_r2_objects(client, config, prefix):
+    """List every object under a prefix, following pagination."""
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=config.r2_bucket, Prefix=prefix):
+        yield from page.get("Contents", [])
+
+
+def delete_r2_objects(client, config, keys):
+    """Delete objects in batches of 1000, the DeleteObjects limit."""
+    for i in range(0, len(keys), 1000):
+        response = client.delete_objects(
+            Bucket=config.r2_bucket,
+            Delete={"Objects": [{"Key": k} for k in keys[i:i + 1000]], "Quiet": True}
+        )
+        errors = response.get("Errors", [])
+        if errors:
+            raise RuntimeError(f"could not delete {len(errors)} object(s): {errors[0]['Message']}")
+
+
+def upload_to_r2(config, file_path, chunks, known=(), tables=None, force=False, chain=None):
+    """Upload new chunks and the backup recipe to Cloudflare R2.
+
+    Chunks in `known` are taken to be in R2 already. Other chunks are only sent if R2
+    doesn't have them yet (from an older backup), unless `force` is set. `chain` names
+    the full backup an incremental base backup builds on.
+    """
+    if not config.r2_enabled:
         print("\n  R2 not configured, skipping upload")
         return None
 
@@ -153,22 +717,46 @@ def upload_to_r2(config, file_path):
 
     try:
         client = get_r2_client(config)
-        key = f"{config['r2_prefix']}/{file_path.name}"
-        file_size = file_path.stat().st_size
-
-        if file_size > 100 * 1024 * 1024:
-            print(f"  Multipart upload ({file_size / (1024*1024):.1f} MB)")
-            from boto3.s3.transfer import TransferConfig
-            transfer_config = TransferConfig(
-                multipart_threshold=100 * 1024 * 1024,
-                multipart_chunksize=100 * 1024 * 1024,
-                max_concurrency=4
-            )
-            client.upload_file(str(file_path), config["r2_bucket"], key, Config=transfer_config)
-        else:
-            client.upload_file(str(file_path), config["r2_bucket"], key)
+        known = set(known)
+        new_chunks = list({c["fp"]: c for c in chunks if c["fp"] not in known}.values())
+        new_size = sum(c["len"] for c in new_chunks)
+        print(f"  {len(new_chunks)}/{len(chunks)} chunk(s) to upload ({new_size / (1024*1024):.1f} MB)")
+
+        if new_chunks:
+            # One read-only mapping shared by all workers, instead of an open/seek/read per chunk
+            with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                def put_chunk(chunk):
+                    if not force and chunk_exists(client, config, chunk["fp"]):
+                        return False
+                    body = data[chunk["offset"]:chunk["offset"] + chunk["len"]]
+                    client.put_object(Bucket=config.r2_bucket, Key=chunk_key(config, chunk["fp"]), Body=body)
+                    return True
+
+                with ThreadPoolExecutor(max_workers=config.r2_concurrency) as pool:
+                    stored = sum(not put for put in pool.map(put_chunk, new_chunks))
+            if stored:
+                print(f"  {stored} chunk(s) already in R2 from older backups")
+
+        recipe = {
+            "file": file_path.name,
+            "size": file_path.stat().st_size,
+            "created": datetime.now().isoformat(),
+            "algo": HASH_ALGO,
+            "chunks": chunks,
+        }
+        if tables:
+            recipe["tables"] = tables
+        if chain:
+            recipe["chain"] = chain
+        key = recipe_key(config, file_path.stem)
+        client.put_object(
+            Bucket=config.r2_bucket,
+            Key=key,
+            Body=orjson.dumps(recipe),
+            ContentType="application/json"
+        )
 
-        print(f"  Done: {config['r2_bucket']}/{key}")
+        print(f"  Done: {config.r2_bucket}/{key}")
         return key
 
     except Exception as e:
@@ -176,39 +764,174 @@ def upload_to_r2(config, file_path):
         return None
 
 
-def check_changes(backup_path, state):
+def local_chunks(state):
+    """Find the local dump of the last upload and its chunks, if it is still in the dumps directory."""
+    chunks = state.get("chunks", [])
+    if state.get("hash_algo") != HASH_ALGO or not chunks or not state.get("backups"):
+        return None, {}
+
+    path = BACKUP_DIR / state["backups"][-1]["file"]
+    if not path.exists() or not path.stat().st_size:
+        return None, {}
+    return path, {c["fp"]: c for c in chunks}
+
+
+def copy_local_chunk(src, data, dst, chunk):
+    """Append a chunk from the local dump, if the dump still holds it; returns whether it did."""
+    start, end = chunk["offset"], chunk["offset"] + chunk["len"]
+    if end > len(data):
+        return False
+
+    # Hash straight from the mapped page cache, the bytes are then copied by the kernel
+    with memoryview(data) as view, view[start:end] as part:
+        if chunk_hasher(part).hexdigest() != chunk["fp"]:
+            return False
+
+    position = dst.tell()
+    try:
+        copy_range(src, dst, start, chunk["len"])
+    except ValueError:
+        # The dump shrank since it was checked
+        dst.seek(position)
+        dst.truncate()
+        return False
+    return True
+
+
+def copy_range(src, dst, offset, length):
+    """Append a byte range of one file to another, inside the kernel where the platform allows it."""
+    if hasattr(os, "copy_file_range"):
+        try:
+            while length:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), length, offset)
+                if not copied:
+                    raise ValueError("local dump is shorter than expected")
+                offset += copied
+                length -= copied
+            return
+        except OSError as e:
+            # Not supported for this pair of files, copy the rest in userspace
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+
+    src.seek(offset)
+    data = src.read(length)
+    if len(data) != length:
+        raise ValueError("local dump is shorter than expected")
+    dst.write(data)
+
+
+def restore_from_r2(config, name):
+    """Rebuild a backup file in the dumps directory from its R2 recipe."""
+    if not config.r2_enabled:
+        print("R2 not configured")
+        return None
+
+    if name.endswith(".json"):
+        name = name[:-len(".json")]
+
+    print(f"Restoring {name}...")
+    partial = None
+
+    try:
+        client = get_r2_client(config)
+        recipe = load_recipe(client, config, recipe_key(config, name))
+        BACKUP_DIR.mkdir(exist_ok=True)
+        target = BACKUP_DIR / recipe["file"]
+        partial = target.with_name(target.name + ".part")
+        verify = recipe.get("algo") == HASH_ALGO
+
+        # Chunks shared with the last upload are copied from its local dump instead of downloaded
+        source, local = local_chunks(load_state()) if verify else (None, {})
+        reused = mismatched = 0
+
+        with ExitStack() as stack:
+            # Unbuffered, so kernel copies and writes can be mixed on the same file
+            f = stack.enter_context(open(partial, "wb", buffering=0))
+            if source:
+                src = stack.enter_context(open(source, "rb"))
+                data = stack.enter_context(mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ))
+            for chunk in recipe["chunks"]:
+                if chunk["fp"] in local:
+                    # Every local chunk is verified too, anything that doesn't match is downloaded
+                    if copy_local_chunk(src, data, f, local[chunk["fp"]]):
+                        reused += chunk["len"]
+                        continue
+                    mismatched += 1
+                response = client.get_object(Bucket=config.r2_bucket, Key=chunk_key(config, chunk["fp"]))
+                body = response["Body"].read()
+                if verify and chunk_hasher(body).hexdigest() != chunk["fp"]:
+                    raise ValueError(f"chunk {chunk['fp']} is corrupt")
+                f.write(body)
+
+        os.replace(partial, target)
+        if mismatched:
+            print(f"  {mismatched} chunk(s) of local dump {source.name} didn't match, downloaded them instead")
+        if reused:
+            print(f"  Copied {reused / (1024 * 1024):.2f} MB from local dump {source.name}")
+        print(f"  Restored: {target} ({recipe['size'] / (1024 * 1024):.2f} MB)")
+        return target
+
+    except Exception as e:
+        print(f"  Restore failed: {e}")
+        if partial and partial.exists():
+            partial.unlink()
+        return None
+
+
+def check_changes(chunks, state, content=None):
     """Check if backup has changed."""
-    current_hash = calculate_hash(backup_path)
+    previous = known_fingerprints(state)
 
-    if state.get("last_hash") == current_hash:
-        print(f"\n  No changes (hash match)")
-        return False, current_hash
+    # The chunks of a pg_dump always differ, since its TOC records the dump time
+    if content and previous and content == state.get("content_fp"):
+        print(f"\n  No changes (table and schema fingerprints match)")
+        return False
+    if previous == [c["fp"] for c in chunks]:
+        print(f"\n  No changes (chunk fingerprints match)")
+        return False
 
-    print(f"\n  Changes detected")
-    return True, current_hash
+    known = set(previous)
+    changed = sum(1 for c in chunks if c["fp"] not in known)
+    print(f"\n  Changes detected ({changed}/{len(chunks)} chunks changed)")
+    return True
 
 
-def cleanup_local(config):
-    """Remove old local backups."""
+def scan_local_backups(suffixes=BACKUP_SUFFIXES):
+    """List (name, stat) of local backup files with a single directory scan."""
     if not BACKUP_DIR.exists():
-        return
+        return []
 
-    cutoff = datetime.now() - timedelta(days=config["keep_local_days"])
-    removed = 0
+    with os.scandir(BACKUP_DIR) as entries:
+        return [
+            (e.name, e.stat())
+            for e in entries
+            if e.name.startswith("backup_") and e.name.endswith(suffixes) and e.is_file()
+        ]
 
-    for backup in BACKUP_DIR.glob("backup_*.sql"):
-        mtime = datetime.fromtimestamp(backup.stat().st_mtime)
-        if mtime < cutoff:
-            backup.unlink()
-            removed += 1
+
+def cleanup_local(config):
+    """Remove old local backups, and files left behind by interrupted runs and restores."""
+    cutoff = (datetime.now() - timedelta(days=config.keep_local_days)).timestamp()
+    removed = leftovers = 0
+
+    for name, st in scan_local_backups(BACKUP_SUFFIXES + LEFTOVER_SUFFIXES):
+        if st.st_mtime < cutoff:
+            (BACKUP_DIR / name).unlink()
+            if name.endswith(BACKUP_SUFFIXES):
+                removed += 1
+            else:
+                leftovers += 1
 
     if removed:
         print(f"  Removed {removed} old local backup(s)")
+    if leftovers:
+        print(f"  Removed {leftovers} leftover manifest or partial file(s)")
 
 
 def send_email(config, subject, body):
     """Send email notification via AWS SES."""
-    if not all([config["aws_access_key"], config["aws_secret_key"], config["email_from"], config["email_to"]]):
+    if not all([config.aws_access_key, config.aws_secret_key, config.email_from, config.email_to]):
         print("  Email not configured, skipping")
         return False
 
@@ -217,16 +940,16 @@ def send_email(config, subject, body):
 
         ses = boto3.client(
             "ses",
-            aws_access_key_id=config["aws_access_key"],
-            aws_secret_access_key=config["aws_secret_key"],
-            region_name=config["aws_region"]
+            aws_access_key_id=config.aws_access_key,
+            aws_secret_access_key=config.aws_secret_key,
+            region_name=config.aws_region
         )
 
         # Support multiple recipients (comma-separated)
-        recipients = [e.strip() for e in config["email_to"].split(",")]
+        recipients = [e.strip() for e in config.email_to.split(",")]
 
         ses.send_email(
-            Source=config["email_from"],
+            Source=config.email_from,
             Destination={"ToAddresses": recipients},
             Message={
                 "Subject": {"Data": subject, "Charset": "UTF-8"},
@@ -241,29 +964,143 @@ def send_email(config, subject, body):
         return False
 
 
-def cleanup_r2(config):
-    """Remove old R2 backups."""
-    if not all([config["r2_account_id"], config["r2_access_key"], config["r2_secret_key"], config["r2_bucket"]]):
+def configure_r2_lifecycle(client, config, state):
+    """Let R2 expire old backups through bucket lifecycle rules, set once per prefix and retention."""
+    prefix = config.r2_prefix
+    wanted = {"prefix": prefix, "days": config.keep_remote_days}
+    if state.get("lifecycle") == wanted:
+        return True
+
+    # Recipes, plus single-file dumps uploaded before the chunk store
+    targets = {
+        f"{prefix}-expire-recipes": f"{prefix}/recipes/",
+        f"{prefix}-expire-legacy": f"{prefix}/backup_",
+    }
+
+    try:
+        try:
+            rules = client.get_bucket_lifecycle_configuration(Bucket=config.r2_bucket)["Rules"]
+        except client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchLifecycleConfiguration":
+                raise
+            rules = []
+
+        # Keep rules that belong to anything else in the bucket
+        rules = [r for r in rules if r.get("ID") not in targets]
+        for rule_id, rule_prefix in targets.items():
+            rules.append({
+                "ID": rule_id,
+                "Filter": {"Prefix": rule_prefix},
+                "Status": "Enabled",
+                "Expiration": {"Days": config.keep_remote_days}
+            })
+
+        client.put_bucket_lifecycle_configuration(
+            Bucket=config.r2_bucket,
+            LifecycleConfiguration={"Rules": rules}
+        )
+
+    except client.exceptions.ClientError as e:
+        print(f"  Lifecycle rules not set ({e}), expiring backups client-side")
+        return False
+
+    state["lifecycle"] = wanted
+    print(f"  Lifecycle rules set: R2 expires backups after {config.keep_remote_days} days")
+    return True
+
+
+def expire_r2_backups(client, config, keep=()):
+    """Remove old R2 backups client-side, for buckets without lifecycle rules."""
+    cutoff = datetime.now() - timedelta(days=config.keep_remote_days)
+    chunk_prefix = f"{config.r2_prefix}/chunks/"
+
+    expired = [
+        obj["Key"]
+        # The trailing slash keeps other prefixes starting with the same name (backups_db2/) out
+        for obj in list_r2_objects(client, config, f"{config.r2_prefix}/")
+        if not obj["Key"].startswith(chunk_prefix)
+        and obj["Key"] not in keep
+        and obj["LastModified"].replace(tzinfo=None) < cutoff
+    ]
+
+    if expired:
+        delete_r2_objects(client, config, expired)
+        print(f"  Removed {len(expired)} old R2 backup(s)")
+
+
+def latest_recipes(state):
+    """R2 keys of the recipes the latest backup needs (its whole chain), which must never expire."""
+    if state.get("chain"):
+        return state["chain"]
+    if not state.get("backups"):
+        return []
+    return [state["backups"][-1]["r2_key"]]
+
+
+def refresh_recipes(client, config, keys):
+    """Re-write recipes in place, so their age for expiry counts from now."""
+    for key in keys:
+        client.copy_object(
+            Bucket=config.r2_bucket,
+            Key=key,
+            CopySource={"Bucket": config.r2_bucket, "Key": key},
+            MetadataDirective="REPLACE",
+            ContentType="application/json"
+        )
+
+
+def cleanup_r2(config, state):
+    """Expire old R2 backups and remove the chunks no longer referenced by any recipe."""
+    if not config.r2_enabled:
         return
 
     try:
         client = get_r2_client(config)
-        cutoff = datetime.now() - timedelta(days=config["keep_remote_days"])
-        removed = 0
+        recipe_prefix = f"{config.r2_prefix}/recipes/"
+
+        # Expiry goes by age, so a quiet database would otherwise lose its only backup
+        modified = {obj["Key"]: obj["LastModified"] for obj in list_r2_objects(client, config, recipe_prefix)}
+        protected = latest_recipes(state)
+        if any(key not in modified for key in protected):
+            # Upload the next backup in full, rather than trusting chunks it may have shared
+            print("  Latest backup is missing from R2, the next run uploads a new one")
+            state["chunks"] = []
+            state.pop("last_lsn", None)
+            state.pop("chain", None)
+        else:
+            stale = datetime.now() - timedelta(days=config.keep_remote_days / 2)
+            if any(modified[key].replace(tzinfo=None) < stale for key in protected):
+                refresh_recipes(client, config, protected)
+                print(f"  Refreshed {len(protected)} recipe(s) of the latest backup")
 
-        response = client.list_objects_v2(
-            Bucket=config["r2_bucket"],
-            Prefix=config["r2_prefix"]
-        )
+        # Give every recipe of a completed chain the same age, so no incremental outlives its full backup
+        for chain in state.get("closed_chains", []):
+            refresh_recipes(client, config, [key for key in chain if key in modified])
+        state.pop("closed_chains", None)
 
-        for obj in response.get("Contents", []):
-            obj_time = obj["LastModified"].replace(tzinfo=None)
-            if obj_time < cutoff:
-                client.delete_object(Bucket=config["r2_bucket"], Key=obj["Key"])
-                removed += 1
+        if not configure_r2_lifecycle(client, config, state):
+            expire_r2_backups(client, config, protected)
+
+        chunk_prefix = f"{config.r2_prefix}/chunks/"
+        recipes = [obj["Key"] for obj in list_r2_objects(client, config, recipe_prefix)]
+
+        # Chunks are shared between backups, so they are only collected once some recipe is gone
+        gone = set(state.get("r2_recipes", recipes)) - set(recipes)
+        if gone:
+            referenced = set()
+            for key in recipes:
+                referenced.update(c["fp"] for c in load_recipe(client, config, key)["chunks"])
+
+            stored = {obj["Key"][len(chunk_prefix):] for obj in list_r2_objects(client, config, chunk_prefix)}
+            orphans = stored - referenced
+            if orphans:
+                delete_r2_objects(client, config, [chunk_key(config, fp) for fp in sorted(orphans)])
+                print(f"  Removed {len(orphans)} unreferenced chunk(s) of {len(gone)} expired backup(s)")
 
-        if removed:
-            print(f"  Removed {removed} old R2 backup(s)")
+            # Never count a deleted chunk as already uploaded
+            state["chunks"] = [c for c in state.get("chunks", []) if c["fp"] in stored - orphans]
+
+        state["r2_recipes"] = recipes
 
     except Exception as e:
         print(f"  R2 cleanup error: {e}")
@@ -275,37 +1112,31 @@ def list_backups(config):
     print("  LOCAL BACKUPS")
     print("=" * 50)
 
-    if BACKUP_DIR.exists():
-        backups = sorted(BACKUP_DIR.glob("backup_*.sql"), reverse=True)
-        if backups:
-            for b in backups:
-                size = b.stat().st_size / (1024 * 1024)
-                mtime = datetime.fromtimestamp(b.stat().st_mtime)
-                print(f"  {b.name} | {size:.2f} MB | {mtime:%Y-%m-%d %H:%M}")
-        else:
-            print("  (none)")
+    backups = sorted(scan_local_backups(), key=lambda b: b[1].st_mtime, reverse=True)
+    if backups:
+        for name, st in backups:
+            size = st.st_size / (1024 * 1024)
+            mtime = datetime.fromtimestamp(st.st_mtime)
+            print(f"  {name} | {size:.2f} MB | {mtime:%Y-%m-%d %H:%M}")
     else:
         print("  (none)")
 
-    if all([config["r2_account_id"], config["r2_access_key"], config["r2_secret_key"], config["r2_bucket"]]):
+    if config.r2_enabled:
         print("\n" + "=" * 50)
         print("  R2 BACKUPS")
         print("=" * 50)
 
         try:
             client = get_r2_client(config)
-            response = client.list_objects_v2(
-                Bucket=config["r2_bucket"],
-                Prefix=config["r2_prefix"]
-            )
-
-            contents = response.get("Contents", [])
+            contents = list(list_r2_objects(client, config, f"{config.r2_prefix}/recipes/"))
             if contents:
-                for obj in sorted(contents, key=lambda x: x["LastModified"], reverse=True):
-                    size = obj["Size"] / (1024 * 1024)
-                    mtime = obj["LastModified"]
-                    name = obj["Key"].split("/")[-1]
-                    print(f"  {name} | {size:.2f} MB | {mtime:%Y-%m-%d %H:%M}")
+                # Sort by when the backup was taken, LastModified changes whenever a recipe is refreshed
+                recipes = [(obj["Key"], load_recipe(client, config, obj["Key"])) for obj in contents]
+                for key, recipe in sorted(recipes, key=lambda r: r[1]["created"], reverse=True):
+                    size = recipe["size"] / (1024 * 1024)
+                    created = datetime.fromisoformat(recipe["created"])
+                    name = key.split("/")[-1][:-len(".json")]
+                    print(f"  {name} | {size:.2f} MB | {len(recipe['chunks'])} chunks | {created:%Y-%m-%d %H:%M}")
             else:
                 print("  (none)")
 
@@ -324,8 +1155,32 @@ def run_backup(force=False):
     state = load_state()
     backup_result = {"success": False, "uploaded": False, "file": None, "size": 0, "error": None}
 
+    incremental = config.backup_mode == "incremental" and incremental_supported(config)
+
+    # Nothing can have changed if no WAL was written since the last backup. A base backup
+    # writes WAL itself, so this only applies to pg_dump backups.
+    lsn = None if incremental else current_wal_lsn(config)
+    if lsn and lsn == state.get("last_lsn") and not force:
+        print(f"\nSkipped (WAL position unchanged at {lsn})")
+        backup_result["success"] = True
+        backup_result["skipped"] = True
+        backup_result["reason"] = f"WAL position unchanged at {lsn}."
+        finish_backup(config, state, backup_result)
+        return True
+
     # Create backup
-    backup_path = create_backup(config)
+    if incremental:
+        last_full = state.get("last_full")
+        full = (
+            not last_full
+            or not state.get("last_manifest")
+            or not Path(state["last_manifest"]).exists()
+            or not state.get("chain")
+            or datetime.now() - datetime.fromisoformat(last_full) >= timedelta(days=config.full_backup_days)
+        )
+        backup_path, chunks, tables, content = create_basebackup(config, None if full else state["last_manifest"])
+    else:
+        backup_path, chunks, tables, content = create_backup(config)
     if not backup_path:
         print("\nBACKUP FAILED!")
         backup_result["error"] = "Failed to create backup"
@@ -336,18 +1191,57 @@ def run_backup(force=False):
     backup_result["size"] = backup_path.stat().st_size / (1024 * 1024)
 
     # Check changes
-    needs_upload, current_hash = check_changes(backup_path, state)
+    needs_upload = check_changes(chunks, state, content)
+
+    # Point every unchanged table at the backup where it last changed
+    previous = state.get("tables", {})
+    table_refs = {}
+    for table, fp in tables.items():
+        if previous.get(table, {}).get("fp") == fp:
+            table_refs[table] = previous[table]
+        else:
+            table_refs[table] = {"fp": fp, "since": backup_path.stem}
+    changed = sorted(t for t in tables if table_refs[t]["since"] == backup_path.stem)
+    if tables:
+        names = ", ".join(changed[:10]) + (", ..." if len(changed) > 10 else "")
+        print(f"\nTables changed: {len(changed)}/{len(tables)}" + (f" ({names})" if changed else ""))
+        backup_result["tables"] = (len(changed), len(tables))
 
     if needs_upload or force:
-        r2_key = upload_to_r2(config, backup_path)
+        # A forced run re-uploads every chunk, which also repairs a damaged chunk store
+        known = [] if force else known_fingerprints(state)
+        # An incremental backup belongs to the chain started by its full backup
+        chain = None
+        if incremental:
+            chain = backup_path.stem if full else Path(state["chain"][0]).stem
+        r2_key = upload_to_r2(config, backup_path, chunks, known, table_refs, force, chain)
 
-        state["last_hash"] = current_hash
         state["last_upload"] = datetime.now().isoformat()
 
         if r2_key:
+            # Only remember chunks that are known to be in R2, so failed uploads are retried
+            state["chunks"] = chunks
+            state["tables"] = table_refs
+            state["content_fp"] = content
+            state["hash_algo"] = HASH_ALGO
+            state["last_lsn"] = lsn
+            if incremental:
+                os.replace(backup_path.with_suffix(".manifest"), MANIFEST_FILE)
+                state["last_manifest"] = str(MANIFEST_FILE)
+                if full:
+                    state["last_full"] = datetime.now().isoformat()
+            if incremental and not full:
+                state["chain"].append(r2_key)
+            else:
+                # The previous chain is complete now; its recipes get one last refresh so they expire together
+                if len(state.get("chain", [])) > 1:
+                    state["closed_chains"] = state.get("closed_chains", []) + [state["chain"]]
+                state.pop("chain", None)
+                if incremental:
+                    state["chain"] = [r2_key]
             state["backups"].append({
                 "file": backup_path.name,
-                "hash": current_hash,
+                "chunks": len(chunks),
                 "r2_key": r2_key,
                 "timestamp": datetime.now().isoformat()
             })
@@ -362,26 +1256,33 @@ def run_backup(force=False):
         backup_result["success"] = True
     else:
         backup_path.unlink()
+        backup_path.with_suffix(".manifest").unlink(missing_ok=True)
+        state["last_lsn"] = lsn
         print("\nSkipped (no changes)")
         backup_result["success"] = True
         backup_result["skipped"] = True
 
+    finish_backup(config, state, backup_result)
+    return True
+
+
+def finish_backup(config, state, backup_result):
+    """Clean up old backups, save the state and send the report."""
     # Cleanup
     print("\nCleanup:")
     cleanup_local(config)
-    cleanup_r2(config)
+    cleanup_r2(config, state)
+    save_state(state)
 
     # Send email report
     print("\nEmail report:")
     send_backup_report(config, backup_result)
 
-    return True
-
 
 def send_backup_report(config, result):
     """Send backup report via email."""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    db_name = config.get("db_name", "unknown")
+    db_name = config.db_name or "unknown"
 
     if result.get("error"):
         subject = f"[BACKUP FAILED] {db_name} - {timestamp}"
@@ -400,7 +1301,7 @@ Please check the backup system immediately.
 Database: {db_name}
 Time: {timestamp}
 
-No changes since last backup. Database hash unchanged.
+No changes since last backup. {result.get('reason', 'Chunk fingerprints unchanged.')}
 """
     else:
         subject = f"[BACKUP OK] {db_name} - {result.get('size', 0):.2f} MB"
@@ -413,6 +1314,8 @@ Size: {result.get('size', 0):.2f} MB
 Uploaded to R2: {'Yes' if result.get('uploaded') else 'No'}
 R2 Location: {result.get('r2_key', 'N/A')}
 """
+        if result.get("tables"):
+            body += "Tables changed: {}/{}\n".format(*result["tables"])
 
     send_email(config, subject, body)
 
@@ -426,12 +1329,15 @@ if __name__ == "__main__":
             list_backups(load_env())
         elif cmd == "--force":
             run_backup(force=True)
+        elif cmd == "--restore" and len(sys.argv) > 2:
+            restore_from_r2(load_env(), sys.argv[2])
         elif cmd == "--help":
             print("Usage: python backup.py [option]")
             print("")
-            print("  (none)   Incremental backup")
-            print("  --force  Force upload")
-            print("  --list   List backups")
+            print("  (none)          Incremental backup")
+            print("  --force         Force upload of every chunk")
+            print("  --list          List backups")
+            print("  --restore NAME  Rebuild an R2 backup into dumps/")
         else:
             print(f"Unknown: {cmd}")
     else:
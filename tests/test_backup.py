@@ -0,0 +1,67 @@
+import io
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import backup
+
+
+AVG_SIZE = 64 * 1024
+
+
+def write_chunked(sizes):
+    """Write random blocks of the given sizes, cutting after each one like after a table."""
+    out = io.BytesIO()
+    writer = backup.ChunkWriter(out, AVG_SIZE)
+    for size in sizes:
+        writer.write(os.urandom(size))
+        writer.cut()
+    return writer, writer.finish(), out.getvalue()
+
+
+def test_cut_leaves_no_chunk_below_min_size():
+    for _ in range(20):
+        writer, chunks, _ = write_chunked([int(AVG_SIZE * 0.9)] * 5)
+        assert all(c["len"] >= writer.min_size for c in chunks)
+        assert all(c["len"] <= writer.max_size for c in chunks)
+
+
+def test_cut_chunks_cover_the_data():
+    writer, chunks, data = write_chunked([100, AVG_SIZE * 3 + 17, 5, AVG_SIZE // 3, AVG_SIZE * 2])
+    assert [c["offset"] for c in chunks] == [0] + [c["offset"] + c["len"] for c in chunks[:-1]]
+    assert sum(c["len"] for c in chunks) == len(data)
+    for c in chunks:
+        body = data[c["offset"]:c["offset"] + c["len"]]
+        assert backup.chunk_hasher(body).hexdigest() == c["fp"]
+
+
+def toc_int(value, int_size=4):
+    return bytes([value < 0]) + abs(value).to_bytes(int_size, "little")
+
+
+def toc_header(version, compression, taken, pg_version=b"16.2"):
+    """Build a TOC header the way pg_dump's WriteHead does."""
+    head = b"PGDMP" + bytes([1, version, 0, 4, 8, 5])
+    head += bytes([compression]) if version >= 15 else toc_int(compression)
+    head += b"".join(toc_int(v) for v in taken)
+    for s in (b"db", pg_version, pg_version):
+        head += toc_int(len(s)) + s
+    return head
+
+
+BODY = b"\x01\x00\x00\x00\x00TABLE DATA public t1"
+
+
+def test_toc_body_strips_header():
+    for version, compression in [(14, -1), (14, 0), (15, 0), (16, 1)]:
+        for taken in [(0, 5, 6, 1, 8, 126, 0), (59, 59, 23, 28, 1, 127, 1)]:
+            assert backup.toc_body(toc_header(version, compression, taken) + BODY) == BODY
+
+
+def test_toc_body_keeps_unparsable_data(capsys):
+    head = toc_header(15, 0, (0, 5, 6, 1, 8, 126, 0))
+    for data in [b"not a dump", head[:20], head[:-3]]:
+        assert backup.toc_body(data) == data
+        assert "Could not parse the dump TOC header" in capsys.readouterr().out